@@ -1,16 +1,27 @@
 # bot_webhook.py — ФИНАЛЬНАЯ ВЕРСИЯ (декабрь 2025)
 # Всё работает: последние записи, уведомления контролёрам, отмена с подтверждением
 import os
-import json
+import atexit
+import calendar
+import functools
+import heapq
+import hmac
 import logging
+import queue
+import re
 import requests
 import threading
 import time
+from collections import defaultdict, deque
 from datetime import datetime, timedelta, timezone
 from flask import Flask, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import gspread
+import orjson
+from gspread.utils import absolute_range_name, rowcol_to_a1
+from google.auth.exceptions import TransportError
 from google.oauth2 import service_account
-from filelock import FileLock
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("bot")
@@ -19,22 +30,64 @@ log = logging.getLogger("bot")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 GOOGLE_CREDS_JSON = os.getenv("GOOGLE_CREDS_JSON")
+REDIS_URL = os.getenv("REDIS_URL")  # необязательно: общие состояния для нескольких воркеров
+VERIFY_HEADERS = os.getenv("VERIFY_HEADERS") == "1"  # сверять заголовки листов при старте
+# необязательно: secret_token из setWebhook, Telegram присылает его в заголовке каждого запроса
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").encode()
 if not all([TELEGRAM_TOKEN, SPREADSHEET_ID, GOOGLE_CREDS_JSON]):
     raise RuntimeError("Missing required env vars")
 
-creds_dict = json.loads(GOOGLE_CREDS_JSON)
+creds_dict = orjson.loads(GOOGLE_CREDS_JSON)
 creds = service_account.Credentials.from_service_account_info(
     creds_dict,
     scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
 )
 
 gc = gspread.authorize(creds)
+# Без таймаута зависший сокет держит замок пользователя и поток обработки
+gc.set_timeout((5, 30))
 sh = gc.open_by_key(SPREADSHEET_ID)
 
+# ==================== Повторы при 429/5xx от Google Sheets ====================
+RETRY_STATUSES = (429, 500, 502, 503)
+
+def retry_after(headers, default):
+    # Retry-After бывает и HTTP-датой — тогда ждём по своему расписанию
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return default
+
+def sheets_call(fn, *args, attempts=4, retry=RETRY_STATUSES, **kwargs):
+    delay = 1
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = e.response.status_code
+            if status not in retry or attempt == attempts - 1:
+                raise
+            wait = min(retry_after(e.response.headers, delay), 60)
+            log.warning(f"Sheets API {status}, повтор через {wait:.0f} с")
+            time.sleep(wait)
+            delay *= 2
+
 # ==================== Московское время ====================
 MSK = timezone(timedelta(hours=3))
-def now_msk():
-    return datetime.now(MSK)
+
+# Строки текущего времени пересчитываются не чаще раза в секунду:
+# (дата, время, метка для записи, день, начало минуты)
+_NOW_CACHE = {"sec": None, "vals": None}
+
+def fmt_now():
+    sec = int(time.time())
+    if sec != _NOW_CACHE["sec"]:
+        now = datetime.fromtimestamp(sec, MSK)
+        _NOW_CACHE["vals"] = (now.strftime("%d.%m.%Y"), now.strftime("%H:%M"),
+                              now.strftime("%Y-%m-%d %H:%M:%S"), now.date(),
+                              now.replace(second=0))
+        _NOW_CACHE["sec"] = sec
+    return _NOW_CACHE["vals"]
 
 # ==================== Листы ====================
 STARTSTOP_SHEET = "Старт-Стоп"
@@ -44,50 +97,140 @@ CTRL_DEFECT_SHEET = "Контр_Брак"
 
 HEADERS_STARTSTOP = ["Дата","Время","Номер линии","Действие","Причина","ЗНП","Метров брака","Вид брака","Пользователь","Время отправки","Статус"]
 HEADERS_DEFECT    = ["Дата","Время","Номер линии","Действие","ЗНП","Метров брака","Вид брака","Пользователь","Время отправки","Статус"]
+USER_COL = {STARTSTOP_SHEET: HEADERS_STARTSTOP.index("Пользователь"), DEFECT_SHEET: HEADERS_DEFECT.index("Пользователь")}
+STATUS_COL = {STARTSTOP_SHEET: HEADERS_STARTSTOP.index("Статус"), DEFECT_SHEET: HEADERS_DEFECT.index("Статус")}
+SENT_COL = {STARTSTOP_SHEET: HEADERS_STARTSTOP.index("Время отправки"), DEFECT_SHEET: HEADERS_DEFECT.index("Время отправки")}
+
+# Все листы узнаём одним запросом метаданных и дальше берём из словаря
+WORKSHEETS = {}
 
 def get_ws(sheet_name, headers=None):
-    try:
-        ws = sh.worksheet(sheet_name)
-    except gspread.exceptions.WorksheetNotFound:
-        ws = sh.add_worksheet(title=sheet_name, rows=3000, cols=20)
-    if headers and ws.row_values(1) != headers:
-        ws.clear()
-        ws.insert_row(headers, 1)
+    if not WORKSHEETS:
+        WORKSHEETS.update((w.title, w) for w in sheets_call(sh.worksheets))
+    ws = WORKSHEETS.get(sheet_name)
+    # Создание листа и вставка заголовков не идемпотентны — после 5xx они могли пройти,
+    # поэтому повторяем только 429
+    if ws is None:
+        ws = WORKSHEETS[sheet_name] = sheets_call(sh.add_worksheet, title=sheet_name, rows=3000, cols=20,
+                                                  retry=(429,))
+        if headers:
+            sheets_call(ws.insert_row, headers, 1, retry=(429,))
+    elif headers and VERIFY_HEADERS and sheets_call(ws.row_values, 1) != headers:
+        sheets_call(ws.clear)
+        sheets_call(ws.insert_row, headers, 1, retry=(429,))
     return ws
 
 ws_startstop = get_ws(STARTSTOP_SHEET, HEADERS_STARTSTOP)
 ws_defect    = get_ws(DEFECT_SHEET, HEADERS_DEFECT)
 ws_ctrl_ss   = get_ws(CTRL_STARTSTOP_SHEET)
 ws_ctrl_def  = get_ws(CTRL_DEFECT_SHEET)
+WS_BY_TITLE = {STARTSTOP_SHEET: ws_startstop, DEFECT_SHEET: ws_defect}
 
 # ==================== Контролёры (кешируем) ====================
 def get_controllers(sheet):
     try:
-        ids = sheet.col_values(1)[1:]
+        ids = sheets_call(sheet.col_values, 1)[1:]
         return [int(i.strip()) for i in ids if i.strip().isdigit()]
-    except:
+    except gspread.exceptions.APIError as e:
+        log.error(f"get_controllers error: {e}")
         return []
 
 controllers_startstop = get_controllers(ws_ctrl_ss)
 controllers_defect = get_controllers(ws_ctrl_def)
 
+# ==================== Кеш хвоста листов ====================
+# Нужны только последние строки: читаем диапазон A{start}:K от последних TAIL_ROWS
+# известных строк до конца, держим копию VALUES_TTL секунд и дописываем в неё
+# свои же изменения (новые строки, статус «Удалено»).
+# Кеш — (start, rows, expires): rows[i] — это строка листа с номером start + i.
+VALUES_TTL = 45
+TAIL_ROWS = 200
+_VALUES_CACHE = {}
+_ROW_COUNT = {}  # title -> сколько строк с данными было при последнем чтении
+_VALUES_LOCK = threading.Lock()
+
+def _store_rows(title, start, rows, ttl=VALUES_TTL):
+    _VALUES_CACHE[title] = (start, rows, time.time() + ttl)
+    _ROW_COUNT[title] = start + len(rows) - 1
+
+def cached_rows(ws, ttl=VALUES_TTL):
+    with _VALUES_LOCK:
+        hit = _VALUES_CACHE.get(ws.title)
+        if hit and hit[2] > time.time():
+            return hit[0], hit[1]
+        known = _ROW_COUNT.get(ws.title, 0)
+        if known > TAIL_ROWS:
+            start = known - TAIL_ROWS + 1
+            rows = [list(r) for r in sheets_call(ws.get, f"A{start}:K")]
+            if rows:
+                _store_rows(ws.title, start, rows, ttl)
+                return start, rows
+        # Первое чтение (или лист укоротили) — целиком
+        rows = sheets_call(ws.get_all_values)
+        _store_rows(ws.title, 1, rows, ttl)
+        return 1, rows
+
+def prime_rows(worksheets, ttl=VALUES_TTL):
+    # Просроченные хвосты нескольких листов — одним values.batchGet вместо запроса на лист
+    with _VALUES_LOCK:
+        now = time.time()
+        stale = [ws for ws in worksheets
+                 if not (ws.title in _VALUES_CACHE and _VALUES_CACHE[ws.title][2] > now)]
+        if len(stale) < 2:
+            return
+        starts = [max(_ROW_COUNT.get(ws.title, 0) - TAIL_ROWS + 1, 1) for ws in stale]
+        ranges = [absolute_range_name(ws.title, f"A{start}:K") for ws, start in zip(stale, starts)]
+        resp = sheets_call(sh.values_batch_get, ranges)
+        for ws, start, vr in zip(stale, starts, resp["valueRanges"]):
+            rows = vr.get("values", [])
+            if rows or start == 1:
+                _store_rows(ws.title, start, rows, ttl)
+
+def all_rows(ws):
+    with _VALUES_LOCK:
+        rows = sheets_call(ws.get_all_values)
+        _store_rows(ws.title, 1, rows)
+        return rows
+
+def cache_appended(title, rows, first_row):
+    with _VALUES_LOCK:
+        hit = _VALUES_CACHE.get(title)
+        if not hit:
+            return
+        start, cached, _ = hit
+        if start + len(cached) == first_row:
+            _store_rows(title, start, cached + rows)
+        else:
+            _VALUES_CACHE.pop(title, None)  # лист меняли вручную — перечитаем
+            _ROW_COUNT[title] = first_row + len(rows) - 1
+
+def cache_set_cell(title, row_index, col, value):
+    with _VALUES_LOCK:
+        hit = _VALUES_CACHE.get(title)
+        if not hit or not (hit[0] <= row_index < hit[0] + len(hit[1])):
+            return
+        start, cached, expires = hit
+        cached = list(cached)
+        row = list(cached[row_index - start])
+        row += [""] * (col + 1 - len(row))
+        row[col] = value
+        cached[row_index - start] = row
+        _VALUES_CACHE[title] = (start, cached, expires)
+
 # ==================== Последние записи (без "Удалено") ====================
 def get_last_records(ws, n=2):
     try:
-        values = ws.get_all_values()
-        if len(values) <= 1:
+        start, values = cached_rows(ws)
+        if start == 1:
+            values = values[1:]  # без заголовка
+        if not values:
             return []
 
-        header = values[0]
-        try:
-            status_col_index = header.index("Статус")  # находим колонку "Статус" по названию
-        except ValueError:
-            status_col_index = -1  # если нет — считаем, что нет удалённых
-
+        status_col_index = STATUS_COL[ws.title]
         valid = []
-        for row in reversed(values[1:]):
-            # Если колонка Статус существует и не "Удалено"
-            if status_col_index == -1 or len(row) <= status_col_index or row[status_col_index].strip() != "Удалено":
+        for row in reversed(values):
+            # Пропускаем строки со статусом "Удалено"
+            if len(row) <= status_col_index or row[status_col_index].strip() != "Удалено":
                 valid.append(row)
                 if len(valid) >= n:
                     break
@@ -96,23 +239,230 @@ def get_last_records(ws, n=2):
         log.error(f"get_last_records error: {e}")
         return []
 
+# ==================== Telegram: keep-alive сессия + очередь исходящих ====================
+TG_SEND = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+SESSION = requests.Session()
+SESSION.headers.update(JSON_HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=frozenset(["POST"]))
+))
+# Очередь выбирается по chat_id: в один чат сообщения идут по порядку, разные чаты — параллельно
+SENDERS = 4
+OUTBOX = [queue.Queue(maxsize=1000) for _ in range(SENDERS)]
+
+# Лимиты Telegram: ~30 сообщений/с на бота и ~1/с в один чат (короткий всплеск допустим).
+# Перед отправкой берём токен из корзины чата и общей (ключ None), а не ловим 429
+SEND_RATE, SEND_BURST = 30, 30
+CHAT_RATE, CHAT_BURST = 1, 3
+BUCKETS = {}  # key -> [токены, время пополнения]
+BUCKETS_LOCK = threading.Lock()
+
+def _token_delay(chat_id):
+    # 0 — токены взяты; иначе сколько секунд ждать, пока они появятся
+    with BUCKETS_LOCK:
+        now = time.monotonic()
+        if len(BUCKETS) > 1000:
+            # Давно молчавшие чаты уже с полной корзиной — это то же, что её отсутствие
+            for k in [k for k, b in BUCKETS.items() if now - b[1] > CHAT_BURST / CHAT_RATE]:
+                del BUCKETS[k]
+        taken = []
+        for key, rate, burst in ((chat_id, CHAT_RATE, CHAT_BURST), (None, SEND_RATE, SEND_BURST)):
+            b = BUCKETS.setdefault(key, [burst, now])
+            b[0] = min(burst, b[0] + (now - b[1]) * rate)
+            b[1] = now
+            taken.append((b, rate))
+        wait = max((1 - b[0]) / rate for b, rate in taken)
+        if wait > 0:
+            return wait
+        for b, _ in taken:
+            b[0] -= 1
+        return 0
+
+def _deliver(item):
+    # item = [chat_id, тело запроса, был ли уже 429]; вернёт, через сколько секунд повторить,
+    # или None — сообщение отправлено либо отброшено
+    chat_id, body, retried = item
+    wait = _token_delay(chat_id)
+    if wait:
+        return wait
+    try:
+        resp = SESSION.post(TG_SEND, data=body, timeout=10)
+    except requests.RequestException as e:
+        log.exception(f"send error: {e}")
+        return None
+    if resp.status_code < 300:
+        return None
+    try:
+        err = orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
+        err = {}
+    if resp.status_code == 429 and not retried:
+        # Telegram сам сообщает, сколько ждать: parameters.retry_after
+        item[2] = True
+        wait = (err.get("parameters") or {}).get("retry_after", 1)
+        log.warning(f"429 для чата {chat_id}, повтор через {wait} с")
+        return min(wait, 60)
+    log.error(f"sendMessage в чат {chat_id}: {resp.status_code} {err.get('description', '')}")
+    return None
+
+def enqueue(payload):
+    # orjson пишет UTF-8 сразу, без \u-экранирования кириллицы
+    item = [payload["chat_id"], orjson.dumps(payload), False]
+    try:
+        OUTBOX[payload["chat_id"] % SENDERS].put(item, timeout=5)
+    except queue.Full:
+        # Отправлять в обход очереди нельзя — сообщение обгонит уже стоящие в этот чат
+        log.error(f"OUTBOX переполнен, сообщение в чат {payload['chat_id']} отброшено")
+
+HELD_MAX = 1000  # отложенных сообщений на очередь; сверх этого копит уже сама OUTBOX
+
+def _sender_loop(q):
+    # Чат, упёршийся в лимит, не держит поток: его сообщения ждут в held до своего срока,
+    # остальные чаты этой очереди идут дальше. Чат в held <=> ровно одна запись в ready
+    held = {}    # chat_id -> deque сообщений по порядку
+    ready = []   # куча (когда можно слать, chat_id)
+    backlog = 0  # сообщений в held
+    while True:
+        item = None
+        if backlog < HELD_MAX:
+            try:
+                item = q.get(timeout=max(ready[0][0] - time.monotonic(), 0) if ready else None)
+            except queue.Empty:
+                pass
+        else:
+            # held полон — из очереди не берём, пусть её maxsize ограничивает память
+            time.sleep(max(ready[0][0] - time.monotonic(), 0))
+        if item is not None:
+            backlog += 1
+            if item[0] in held:
+                held[item[0]].append(item)
+            else:
+                held[item[0]] = deque([item])
+                heapq.heappush(ready, (time.monotonic(), item[0]))
+        while ready and ready[0][0] <= time.monotonic():
+            _, chat_id = heapq.heappop(ready)
+            items = held[chat_id]
+            while items:
+                wait = _deliver(items[0])
+                if wait:
+                    heapq.heappush(ready, (time.monotonic() + wait, chat_id))
+                    break
+                items.popleft()
+                backlog -= 1
+                q.task_done()
+            else:
+                del held[chat_id]
+
+for q in OUTBOX:
+    threading.Thread(target=_sender_loop, args=(q,), daemon=True).start()
+
 # ==================== Уведомление контролёрам ====================
 def notify_controllers(ids, message):
     for cid in ids:
-        try:
-            requests.post(
-                f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
-                json={"chat_id": cid, "text": message, "parse_mode": "HTML"},
-                timeout=10
-            )
-        except:
-            pass
+        enqueue({"chat_id": cid, "text": message, "parse_mode": "HTML"})
 
 # ==================== Запись + уведомление ====================
+APPEND_PARAMS = {"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"}
+
+def _raw_append(sheet_name, rows):
+    # Прямой values.append: один HTTP-запрос без обёрток gspread.
+    # append не идемпотентен: после 5xx строки могли уже записаться, поэтому повторяем только 429
+    return sheets_call(sh.values_append, absolute_range_name(sheet_name, "A1"), params=APPEND_PARAMS,
+                       body={"values": rows}, retry=(429,))
+
+def _first_row(resp):
+    # updatedRange вида "'Брак'!A120:J121" -> 120
+    m = re.search(r"!\$?[A-Z]+\$?(\d+)", resp.get("updates", {}).get("updatedRange", ""))
+    return int(m.group(1)) if m else 0
+
+# ==================== Буфер записей: пачка строк за один запрос ====================
+PENDING = {STARTSTOP_SHEET: [], DEFECT_SHEET: []}
+PENDING_DELETES = []  # (лист, номер строки) — статус «Удалено» одним batchUpdate
+MAX_PENDING_DELETES = 100
+PENDING_LOCK = threading.Lock()   # защищает PENDING и PENDING_DELETES
+FLUSH_LOCK = threading.Lock()     # одна отправка за раз; поиск записи для отмены ждёт её
+FLUSH_EVENT = threading.Event()
+FLUSH_INTERVAL = 3
+FLUSH_MAX_ROWS = 20
+
+def transient(e):
+    # 429/5xx и сетевые сбои пройдут при следующей попытке; прочие 4xx (неверный диапазон,
+    # переименованный лист) не пройдут никогда — такую пачку держать в буфере нельзя
+    if isinstance(e, gspread.exceptions.APIError):
+        status = e.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(e, (requests.RequestException, TransportError))
+
+def flush_pending():
+    ok = True
+    with FLUSH_LOCK:
+        with PENDING_LOCK:
+            batches = {name: rows for name, rows in PENDING.items() if rows}
+            for name in batches:
+                PENDING[name] = []
+            deletes = PENDING_DELETES[:]
+            PENDING_DELETES.clear()
+        for name, rows in batches.items():
+            try:
+                resp = _raw_append(name, rows)
+            except Exception as e:
+                if transient(e):
+                    log.error(f"flush_pending error ({name}, {len(rows)} строк): {e}")
+                    ok = False
+                    with PENDING_LOCK:
+                        PENDING[name][:0] = rows  # вернём в начало, уйдут со следующей пачкой
+                else:
+                    log.error(f"flush_pending: строки отброшены ({name}): {e}; {rows}")
+                continue
+            # Строки уже в таблице — ошибка учёта ниже не должна отправить их повторно
+            try:
+                rows = [[str(v) for v in row] for row in rows]
+                first = _first_row(resp)
+                cache_appended(name, rows, first)
+            except Exception as e:
+                log.error(f"flush_pending cache error ({name}): {e}")
+                with _VALUES_LOCK:
+                    _VALUES_CACHE.pop(name, None)
+        # Статусы — после строк: удаляемая строка к этому моменту уже в таблице
+        if deletes:
+            try:
+                data = [{"range": absolute_range_name(title, rowcol_to_a1(row_index, STATUS_COL[title] + 1)),
+                         "values": [["Удалено"]]} for title, row_index in deletes]
+                sheets_call(sh.values_batch_update, {"valueInputOption": "USER_ENTERED", "data": data})
+            except Exception as e:
+                if transient(e):
+                    log.error(f"flush_pending error (статусы, {len(deletes)} шт.): {e}")
+                    ok = False
+                    with PENDING_LOCK:
+                        PENDING_DELETES[:0] = deletes
+                else:
+                    log.error(f"flush_pending: статусы отброшены: {e}; {deletes}")
+    return ok
+
+def flusher():
+    # Пока таблица недоступна, повторяем всё реже (до минуты), чтобы не жечь квоту
+    delay = FLUSH_INTERVAL
+    while True:
+        FLUSH_EVENT.wait(delay)
+        FLUSH_EVENT.clear()
+        delay = FLUSH_INTERVAL if flush_pending() else min(delay * 2, 60)
+
+threading.Thread(target=flusher, daemon=True).start()
+atexit.register(flush_pending)
+
+def has_pending(uid):
+    prefix = f"{uid} "
+    with PENDING_LOCK:
+        return any(row[USER_COL[name]].startswith(prefix) for name, rows in PENDING.items() for row in rows)
+
 def append_row(data):
     flow = data.get("flow", "startstop")
     ws = ws_defect if flow == "defect" else ws_startstop
-    ts = now_msk().strftime("%Y-%m-%d %H:%M:%S")
+    ts = fmt_now()[2]
     user = data["user"]
 
     if flow == "defect":
@@ -124,7 +474,10 @@ def append_row(data):
                data.get("reason", ""), data.get("znp", ""), data["meters"],
                data.get("defect_type", ""), user, ts, ""]
 
-    ws.append_row(row, value_input_option="USER_ENTERED")
+    with PENDING_LOCK:
+        PENDING[ws.title].append(row)
+        if len(PENDING[ws.title]) >= FLUSH_MAX_ROWS:
+            FLUSH_EVENT.set()
 
     # Уведомления
     if flow == "defect":
@@ -146,41 +499,93 @@ def append_row(data):
 
 # ==================== Поиск последней записи пользователя ====================
 def find_last_entry(uid):
-    user_col = 9
-    ts_col = 10
-    for ws, name in [(ws_startstop, "Старт-Стоп"), (ws_defect, "Брак")]:
+    # Свежая запись могла ещё не уйти в таблицу — тогда сначала отправляем буфер.
+    # success=None: запись так и осталась в буфере (429/5xx/сеть) — предыдущую вместо неё
+    # не предлагаем, иначе «Удалено» получит не та строка
+    if has_pending(uid):
+        flush_pending()
+    prefix = f"{uid} "
+
+    def last_match(ws, values, start):
+        user_col, sent_col = USER_COL[ws.title], SENT_COL[ws.title]
+        for i in range(len(values)-1, max(0, 2 - start) - 1, -1):
+            row = values[i]
+            if len(row) > user_col and row[user_col].startswith(prefix):
+                return (row[sent_col] if len(row) > sent_col else ""), ws, row, start + i
+        return None
+
+    # Снизу вверх первая строка пользователя — самая свежая на листе; между листами
+    # выбираем по «Времени отправки» (строки ГГГГ-ММ-ДД чч:мм:сс сравниваются как даты)
+    # Номер строки берём только из свежего скана: старый номер мог уехать, если строки
+    # выше удаляли или вставляли. Кэш хвостов видит лишь записи этого процесса — с REDIS_URL
+    # воркеров несколько и более свежую строку мог дописать другой, поэтому читаем заново
+    found = []
+    with FLUSH_LOCK:
+        # Под FLUSH_LOCK: пачку, которую flusher отправлял в этот момент, при ошибке уже вернули
+        if has_pending(uid):
+            return None, None, None, None, None
+        if rds:
+            with _VALUES_LOCK:
+                for ws in (ws_startstop, ws_defect):
+                    _VALUES_CACHE.pop(ws.title, None)
         try:
-            values = ws.get_all_values()
-            for i in range(len(values)-1, 0, -1):
-                row = values[i]
-                if len(row) >= user_col and str(uid) in row[user_col-1]:
-                    return True, name, row, ws, i + 1
-        except Exception as e:
-            log.error(f"find_last_entry error: {e}")
-    return False, None, None, None, None
+            prime_rows([ws_startstop, ws_defect])
+        except Exception as e:  # таймауты requests, TransportError — ниже всё равно cached_rows
+            log.error(f"prime_rows error: {e}")
+        tails = {}
+        for ws in (ws_startstop, ws_defect):
+            try:
+                start, values = cached_rows(ws)
+                tails[ws.title] = start
+                hit = last_match(ws, values, start)
+                if hit:
+                    found.append(hit)
+            except Exception as e:
+                log.error(f"find_last_entry error: {e}")
+        if not found:
+            # В хвостах нет — редкий случай, читаем листы целиком
+            for ws in (ws_startstop, ws_defect):
+                if tails.get(ws.title, 1) > 1:
+                    try:
+                        hit = last_match(ws, all_rows(ws), 1)
+                        if hit:
+                            found.append(hit)
+                    except Exception as e:
+                        log.error(f"find_last_entry error: {e}")
+    if not found:
+        return False, None, None, None, None
+    _, ws, row, row_index = max(found, key=lambda f: f[0])
+    return True, ws.title, row, ws, row_index
 
 # ==================== Пометить как "Удалено" + уведомление ====================
-def mark_as_deleted(ws, row_index):
+def mark_as_deleted(ws, row_index, row):
     try:
-        ws.update_cell(row_index, 11, "Удалено")
-        row = ws.row_values(row_index)
-        if len(row) >= 11:
-            sheet = ws.title
-            if sheet == DEFECT_SHEET:
-                msg = (f"ЗАПИСЬ БРАКА УДАЛЕНА\n"
-                       f"Линия: {row[2]}\n"
-                       f"{row[0]} {row[1]}\n"
-                       f"ЗНП: <code>{row[4]}</code>\n"
-                       f"Метров: {row[5]}")
-                notify_controllers(controllers_defect, msg)
-            else:
-                action = "Запуск" if row[3] == "запуск" else "Остановка"
-                msg = (f"ЗАПИСЬ СТАРТ/СТОП УДАЛЕНА\n"
-                       f"Линия: {row[2]}\n"
-                       f"{row[0]} {row[1]}\n"
-                       f"Действие: {action}\n"
-                       f"Причина: {row[4] if len(row)>4 else '—'}")
-                notify_controllers(controllers_startstop, msg)
+        status_col = STATUS_COL[ws.title]
+        with PENDING_LOCK:
+            queued = len(PENDING_DELETES) < MAX_PENDING_DELETES
+            if queued:
+                PENDING_DELETES.append((ws.title, row_index))
+        if queued:
+            FLUSH_EVENT.set()
+        else:
+            sheets_call(ws.update_cell, row_index, status_col + 1, "Удалено")
+        cache_set_cell(ws.title, row_index, status_col, "Удалено")
+        row = row + [""] * (6 - len(row))
+        if ws.title == DEFECT_SHEET:
+            msg = (f"ЗАПИСЬ БРАКА УДАЛЕНА\n"
+                   f"Линия: {row[2]}\n"
+                   f"{row[0]} {row[1]}\n"
+                   f"ЗНП: <code>{row[4]}</code>\n"
+                   f"Метров: {row[5]}")
+            notify_controllers(controllers_defect, msg)
+        else:
+            action = "Запуск" if row[3] == "запуск" else "Остановка"
+            msg = (f"ЗАПИСЬ СТАРТ/СТОП УДАЛЕНА\n"
+                   f"Линия: {row[2]}\n"
+                   f"{row[0]} {row[1]}\n"
+                   f"Действие: {action}\n"
+                   f"Причина: {row[4] or '—'}")
+            notify_controllers(controllers_startstop, msg)
     except Exception as e:
         log.error(f"mark_as_deleted error: {e}")
 
@@ -200,75 +605,448 @@ MAIN_KB = keyboard([
 
 CANCEL_KB = keyboard([["Отмена"]])
 CONFIRM_KB = keyboard([["Да, удалить", "Нет"]])
+ACTION_KB = keyboard([["Запуск", "Остановка"], ["Отмена"]])
+MAIN_KB_JSON = orjson.dumps(MAIN_KB).decode()
+CANCEL_KB_JSON = orjson.dumps(CANCEL_KB).decode()
+CONFIRM_KB_JSON = orjson.dumps(CONFIRM_KB).decode()
+
+def kb_json(rows):
+    return orjson.dumps(keyboard(rows)).decode()
+
+# Клавиатуры с датой/временем/префиксами ЗНП меняются раз в минуту или раз в день —
+# собираем и сериализуем их один раз на этот ключ
+@functools.lru_cache(maxsize=2)
+def _date_kb(day):
+    yest = day - timedelta(days=1)
+    return kb_json([["Сейчас"], [day.strftime("%d.%m.%Y"), yest.strftime("%d.%m.%Y")], ["Другая дата", "Отмена"]])
+
+@functools.lru_cache(maxsize=2)
+def _time_kb(minute):
+    t = [(minute - timedelta(minutes=10 * i)).strftime("%H:%M") for i in range(4)]
+    return kb_json([[t[0], t[1], "Другое время"], [t[2], t[3], "Отмена"]])
+
+@functools.lru_cache(maxsize=2)
+def znp_prefixes(day):
+    curr = day.strftime("%m%y")
+    prev = (day.replace(day=1) - timedelta(days=1)).strftime("%m%y")  # прошлый месяц
+    return (f"D{curr}", f"L{curr}", f"D{prev}", f"L{prev}")
+
+@functools.lru_cache(maxsize=2)
+def _znp_kb(day):
+    p = znp_prefixes(day)
+    return kb_json([[p[0], p[1]], [p[2], p[3]], ["Другое", "Отмена"]])
+
+def date_kb():
+    return _date_kb(fmt_now()[3])
+
+def time_kb():
+    return _time_kb(fmt_now()[4])
+
+def znp_kb():
+    return _znp_kb(fmt_now()[3])
+
+# Справочники причин и видов брака: лист -> дополнительные кнопки
+LIST_SHEETS = {"Причина остановки": ["Другое"], "Вид брака": ["Другое", "Без брака"]}
+LISTS_CACHE = {"kb": {}, "until": 0}
+LISTS_TTL = 3600   # справочники правят редко
+LISTS_RETRY = 60   # после ошибки пробуем снова раньше
 
-REASONS_CACHE = {"kb": None, "until": 0}
-DEFECTS_CACHE = {"kb": None, "until": 0}
+def list_kb(values, extra):
+    items = [v.strip() for v in values if v.strip()] + extra
+    rows = [items[i:i+2] for i in range(0, len(items), 2)]
+    rows.append(["Отмена"])
+    return kb_json(rows)
 
-def build_kb(sheet_name, extra=None):
-    if extra is None: extra = []
+# Оба справочника читаются одним values.batchGet раз в LISTS_TTL в фоновом потоке,
+# в кеше лежат уже сериализованные клавиатуры — шаг диалога сеть не ждёт
+def refresh_lists():
+    ranges = [absolute_range_name(name, "A2:A") for name in LIST_SHEETS]
     try:
-        values = sh.worksheet(sheet_name).col_values(1)[1:]
-        items = [v.strip() for v in values if v.strip()] + extra
-        rows = [items[i:i+2] for i in range(0, len(items), 2)]
-        rows.append(["Отмена"])
-        return keyboard(rows)
-    except:
-        return keyboard([extra[i:i+2] for i in range(0, len(extra), 2)] + [["Отмена"]])
+        resp = sheets_call(sh.values_batch_get, ranges)
+        columns = [[r[0] for r in vr.get("values", []) if r] for vr in resp["valueRanges"]]
+    except Exception as e:  # в т.ч. TransportError/RefreshError из google.auth
+        log.error(f"refresh_lists error: {e}")
+        columns = None
+    if columns is not None:
+        LISTS_CACHE["kb"] = {name: list_kb(col, extra) for (name, extra), col in zip(LIST_SHEETS.items(), columns)}
+    elif not LISTS_CACHE["kb"]:
+        LISTS_CACHE["kb"] = {name: list_kb([], extra) for name, extra in LIST_SHEETS.items()}
+    LISTS_CACHE["until"] = time.time() + (LISTS_TTL if columns is not None else LISTS_RETRY)
+
+def lists_refresher():
+    while True:
+        time.sleep(max(LISTS_CACHE["until"] - time.time(), 1))
+        try:
+            refresh_lists()
+        except Exception as e:
+            # Поток не должен умирать — иначе списки больше никогда не обновятся
+            log.exception(f"lists_refresher error: {e}")
+            LISTS_CACHE["until"] = time.time() + LISTS_RETRY
+
+def lists_kb():
+    if not LISTS_CACHE["kb"]:
+        refresh_lists()
+    return LISTS_CACHE["kb"]
+
+threading.Thread(target=lists_refresher, daemon=True).start()
 
 def get_reasons_kb():
-    now = time.time()
-    if now > REASONS_CACHE["until"]:
-        REASONS_CACHE["kb"] = build_kb("Причина остановки", ["Другое"])
-        REASONS_CACHE["until"] = now + 300
-    return REASONS_CACHE["kb"]
+    return lists_kb()["Причина остановки"]
 
 def get_defect_kb():
-    now = time.time()
-    if now > DEFECTS_CACHE["until"]:
-        DEFECTS_CACHE["kb"] = build_kb("Вид брака", ["Другое", "Без брака"])
-        DEFECTS_CACHE["until"] = now + 300
-    return DEFECTS_CACHE["kb"]
+    return lists_kb()["Вид брака"]
 
 # ==================== Отправка сообщений ====================
-def send(chat_id, text, markup=None):
-    payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
+def _post_message(payload):
+    enqueue(payload)
+
+# parse_mode=HTML только там, где в тексте есть разметка
+def send(chat_id, text, markup=None, html=False):
+    payload = {"chat_id": chat_id, "text": text}
+    if html:
+        payload["parse_mode"] = "HTML"
     if markup:
-        payload["reply_markup"] = json.dumps(markup, ensure_ascii=False)
-    try:
-        requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage", json=payload, timeout=10)
-    except Exception as e:
-        log.exception(f"send error: {e}")
+        # Статичные клавиатуры приходят уже сериализованными
+        payload["reply_markup"] = markup if isinstance(markup, str) else orjson.dumps(markup).decode()
+    _post_message(payload)
+
+def send_raw(chat_id, text, markup_json, html=False):
+    payload = {"chat_id": chat_id, "text": text, "reply_markup": markup_json}
+    if html:
+        payload["parse_mode"] = "HTML"
+    _post_message(payload)
+
+# Неизменные подсказки: текст + уже сериализованная клавиатура + нужен ли HTML
+_PROMPTS = {key: (text, orjson.dumps(kb).decode(), "<" in text) for key, (text, kb) in {
+    "MENU":          ("Выберите действие:", MAIN_KB),
+    "CANCELLED":     ("Отменено.", MAIN_KB),
+    "NO_ENTRIES":    ("У вас нет записей для отмены.", MAIN_KB),
+    "SAVING":        ("Последняя запись ещё сохраняется — попробуйте через минуту.", MAIN_KB),
+    "DELETED":       ("Запись помечена как <b>Удалено</b>.", MAIN_KB),
+    "KEPT":          ("Запись сохранена.", MAIN_KB),
+    "LINE":          ("Введите номер линии (1–15):", CANCEL_KB),
+    "LINE_BAD":      ("Номер линии 1–15:", CANCEL_KB),
+    "DATE_CUSTOM":   ("дд.мм.гггг:", CANCEL_KB),
+    "DATE_BAD":      ("Неверная дата.", CANCEL_KB),
+    "DATE_FORMAT":   ("Формат дд.мм.гггг", CANCEL_KB),
+    "TIME_CUSTOM":   ("чч:мм:", CANCEL_KB),
+    "TIME_BAD":      ("Неверное время.", CANCEL_KB),
+    "TIME_FORMAT":   ("Формат чч:мм", CANCEL_KB),
+    "ACTION":        ("Действие:", ACTION_KB),
+    "ACTION_BAD":    ("Выберите:", ACTION_KB),
+    "REASON_CUSTOM": ("Введите причину:", CANCEL_KB),
+    "ZNP_MANUAL":    ("Полный ЗНП (D1125-1234):", CANCEL_KB),
+    "ZNP_BAD":       ("Неправильно. Пример: <code>D1125-1234</code>", CANCEL_KB),
+    "METERS":        ("Метров брака:", CANCEL_KB),
+    "METERS_BAD":    ("Только цифры:", CANCEL_KB),
+    "DEFECT_CUSTOM": ("Опишите вид брака:", CANCEL_KB),
+}.items()}
+
+def send_prompt(chat_id, key):
+    send_raw(chat_id, *_PROMPTS[key])
 
 # ==================== Таймауты ====================
 states = {}
 last_activity = {}
 TIMEOUT = 600
+USER_LOCKS = defaultdict(threading.Lock)  # uid -> замок на его состояние
+USER_LOCKS_GUARD = threading.Lock()       # защищает сам словарь USER_LOCKS
+LOCK_IDLE = 3600
+
+def lock_user(uid):
+    # Пока ждали замок, timeout_worker мог выбросить его из USER_LOCKS — тогда
+    # другой поток возьмёт уже новый замок. Проверяем, что наш всё ещё действующий
+    while True:
+        with USER_LOCKS_GUARD:
+            lock = USER_LOCKS[uid]
+        lock.acquire()
+        with USER_LOCKS_GUARD:
+            if USER_LOCKS.get(uid) is lock:
+                return lock
+        lock.release()
+
+def forget_lock(uid):
+    # Выбрасываем замок, только если его никто не держит
+    with USER_LOCKS_GUARD:
+        lock = USER_LOCKS.get(uid)
+        if lock is None or not lock.acquire(blocking=False):
+            return lock is None
+        del USER_LOCKS[uid]
+        lock.release()
+        return True
+
+TIMEOUTS = []     # куча (срок, uid) — worker спит ровно до ближайшего срока
+SCHEDULED = {}    # uid -> срок его актуальной записи в куче
+TIMEOUTS_CV = threading.Condition()
+
+def schedule(uid, due):
+    with TIMEOUTS_CV:
+        SCHEDULED[uid] = due
+        heapq.heappush(TIMEOUTS, (due, uid))
+        TIMEOUTS_CV.notify()
+
+def touch(uid):
+    now = time.time()
+    last_activity[uid] = now
+    # Одна запись на пользователя: более поздний срок уточним, когда запись всплывёт
+    if now + TIMEOUT < SCHEDULED.get(uid, float("inf")):
+        schedule(uid, now + TIMEOUT)
 
 def timeout_worker():
     while True:
-        time.sleep(30)
+        with TIMEOUTS_CV:
+            while not TIMEOUTS or TIMEOUTS[0][0] > time.time():
+                TIMEOUTS_CV.wait(TIMEOUTS[0][0] - time.time() if TIMEOUTS else None)
+            due, uid = heapq.heappop(TIMEOUTS)
+            if SCHEDULED.get(uid) != due:
+                continue  # запись вытеснена более ранней
+            del SCHEDULED[uid]
         now = time.time()
-        for uid in list(states):
-            if now - last_activity.get(uid, now) > TIMEOUT:
-                send(states[uid]["chat"], "Диалог прерван — неактивность 10 минут.")
-                states.pop(uid, None)
-                last_activity.pop(uid, None)
+        expired = None
+        lock = lock_user(uid)
+        try:
+            seen = last_activity.get(uid)
+            if seen is not None and uid in states:
+                if seen + TIMEOUT > now:
+                    schedule(uid, seen + TIMEOUT); continue
+                expired = states.pop(uid)["chat"]
+                schedule(uid, seen + LOCK_IDLE)
+            elif seen is not None and seen + LOCK_IDLE > now:
+                schedule(uid, seen + LOCK_IDLE); continue
+        finally:
+            lock.release()
+        # Состояние меняли под замком пользователя, сообщение шлём уже после
+        if expired is not None:
+            send(expired, "Диалог прерван — неактивность 10 минут.")
+        elif uid not in states and forget_lock(uid):
+            # Давно не писал — забываем его замок и подпись
+            USER_LABELS.pop(uid, None)
+            last_activity.pop(uid, None)
 
 threading.Thread(target=timeout_worker, daemon=True).start()
 
+# ==================== Состояния в Redis (если задан REDIS_URL) ====================
+# Ключ живёт TIMEOUT секунд — истечение TTL заменяет таймауты timeout_worker
+if REDIS_URL:
+    import redis
+    rds = redis.Redis.from_url(REDIS_URL)
+else:
+    rds = None
+
+def process(uid, chat, text, username):
+    if rds is None:
+        return _process(uid, chat, text, username)
+    # Состояние на время обработки поднимается в states и сохраняется обратно.
+    # Замок в Redis не даёт двум репликам вести один диалог одновременно.
+    key = f"fsm:{uid}"
+    with rds.lock(f"fsm-lock:{uid}", timeout=60, blocking_timeout=30):
+        raw = rds.get(key)
+        if raw:
+            states[uid] = orjson.loads(raw)
+        try:
+            _process(uid, chat, text, username)
+        finally:
+            last_activity.pop(uid, None)
+            st = states.pop(uid, None)
+            if st is not None:
+                rds.set(key, orjson.dumps(st), ex=TIMEOUT)
+            elif raw:
+                rds.delete(key)
+
 # ==================== Основная логика ====================
-def process(uid, chat, text, user_repr):
-    last_activity[uid] = time.time()
+# re.ASCII: иначе \d пропустит «٠١.٠١.٢٠٢٥» и такая дата уйдёт в таблицу (как и в parse_int)
+DATE_RE = re.compile(r"(\d{2})\.(\d{2})\.(\d{4})", re.ASCII)
+TIME_RE = re.compile(r"([01]\d|2[0-3]):[0-5]\d", re.ASCII)
+ZNP_RE = re.compile(r"([DL]\d{4})-\d{4}", re.ASCII)
+MONTH_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def parse_int(text):
+    # isdigit() пропускает «²» и прочие юникодные цифры, на которых int() падает
+    return int(text) if text.isascii() and text.isdigit() else None
+
+def valid_date(text):
+    m = DATE_RE.fullmatch(text)
+    if not m:
+        return False
+    d, mo, y = int(m[1]), int(m[2]), int(m[3])
+    if not 1 <= mo <= 12:
+        return False
+    return 1 <= d <= MONTH_DAYS[mo - 1] + (mo == 2 and calendar.isleap(y))
+
+def ask_znp_prefix(st, chat):
+    st["step"] = "znp_prefix"
+    send_raw(chat, "Префикс ЗНП:", znp_kb())
+
+def after_time(st, chat, flow):
+    if flow == "defect":
+        ask_znp_prefix(st, chat)
+    else:
+        st["step"] = "action"
+        send_prompt(chat, "ACTION")
+
+# ==================== Шаги диалога (линия → дата → время → ...) ====================
+# Каждый шаг — отдельная функция; True означает, что диалог завершён
+def _handle_line(st, data, text, chat, flow):
+    line = parse_int(text)
+    if line is None or not 1 <= line <= 15:
+        send_prompt(chat, "LINE_BAD"); return
+    data["line"] = str(line)
+    st["step"] = "date"
+    send_raw(chat, "Дата:", date_kb())
+
+def _handle_date(st, data, text, chat, flow):
+    if text == "Сейчас":
+        # Дата и время одним нажатием — минус один шаг диалога
+        data["date"], data["time"] = fmt_now()[:2]
+        after_time(st, chat, flow)
+        return
+    if text == "Другая дата":
+        st["step"] = "date_custom"; send_prompt(chat, "DATE_CUSTOM"); return
+    if not valid_date(text):
+        send_prompt(chat, "DATE_BAD"); return
+    data["date"] = text
+    st["step"] = "time"
+    send_raw(chat, "Время:", time_kb())
+
+def _handle_date_custom(st, data, text, chat, flow):
+    if not valid_date(text):
+        send_prompt(chat, "DATE_FORMAT"); return
+    data["date"] = text
+    st["step"] = "time"
+    send_raw(chat, "Время:", time_kb())
+
+def _handle_time(st, data, text, chat, flow):
+    if text == "Другое время":
+        st["step"] = "time_custom"; send_prompt(chat, "TIME_CUSTOM"); return
+    if not TIME_RE.fullmatch(text):
+        send_prompt(chat, "TIME_BAD"); return
+    data["time"] = text
+    after_time(st, chat, flow)
+
+def _handle_time_custom(st, data, text, chat, flow):
+    if not TIME_RE.fullmatch(text):
+        send_prompt(chat, "TIME_FORMAT"); return
+    data["time"] = text
+    after_time(st, chat, flow)
+
+def _handle_action(st, data, text, chat, flow):
+    if text not in ("Запуск", "Остановка"):
+        send_prompt(chat, "ACTION_BAD"); return
+    data["action"] = "запуск" if text == "Запуск" else "остановка"
+    if data["action"] == "запуск":
+        ask_znp_prefix(st, chat)
+    else:
+        st["step"] = "reason"
+        send_raw(chat, "Причина остановки:", get_reasons_kb())
+
+def _handle_reason(st, data, text, chat, flow):
+    if text == "Другое":
+        st["step"] = "reason_custom"; send_prompt(chat, "REASON_CUSTOM"); return
+    _handle_reason_custom(st, data, text, chat, flow)
+
+def _handle_reason_custom(st, data, text, chat, flow):
+    data["reason"] = text
+    ask_znp_prefix(st, chat)
+
+def _handle_znp_prefix(st, data, text, chat, flow):
+    if text in znp_prefixes(fmt_now()[3]):
+        data["znp_prefix"] = text
+        send(chat, f"Последние 4 цифры для <b>{text}</b>-XXXX:", CANCEL_KB_JSON, html=True); return
+    if text == "Другое":
+        st["step"] = "znp_manual"; send_prompt(chat, "ZNP_MANUAL"); return
+    if len(text) == 4 and parse_int(text) is not None and "znp_prefix" in data:
+        data["znp"] = f"{data['znp_prefix']}-{text}"
+        st["step"] = "meters"; send_prompt(chat, "METERS"); return
+    send_raw(chat, "Выберите префикс:", znp_kb())
+
+def _handle_znp_manual(st, data, text, chat, flow):
+    znp = text.upper()
+    m = ZNP_RE.fullmatch(znp)
+    if m and m[1] in znp_prefixes(fmt_now()[3]):
+        data["znp"] = znp
+        st["step"] = "meters"; send_prompt(chat, "METERS"); return
+    send_prompt(chat, "ZNP_BAD")
+
+def _handle_meters(st, data, text, chat, flow):
+    meters = parse_int(text)
+    if meters is None:
+        send_prompt(chat, "METERS_BAD"); return
+    data["meters"] = str(meters)
+    st["step"] = "defect_type"
+    send_raw(chat, "Вид брака:", get_defect_kb())
+
+# Одно подтверждение на оба пути записи (вид брака из списка или введённый вручную)
+CONFIRM_TPL = ("<b>Записано на лист '{sheet}'!</b>\n"
+               "Линия {line} • {date} {time}\n"
+               "Действие: {action}\n"
+               "Причина: {reason}\n"
+               "ЗНП: <code>{znp}</code>\n"
+               "Брака: {meters} м\n"
+               "Вид брака: {defect}")
+
+def finish(data, chat, flow):
+    data["flow"] = flow
+    append_row(data)
+    send(chat, CONFIRM_TPL.format_map({
+        "sheet": "Брак" if flow == "defect" else "Старт-Стоп",
+        "line": data["line"], "date": data["date"], "time": data["time"],
+        "action": "Брак" if flow == "defect" else ("Запуск" if data["action"] == "запуск" else "Остановка"),
+        "reason": data.get("reason", "—"),
+        "znp": data.get("znp", "—"),
+        "meters": data["meters"],
+        "defect": data.get("defect_type") or "—",
+    }), MAIN_KB_JSON, html=True)
+    return True
+
+def _handle_defect_type(st, data, text, chat, flow):
+    if text == "Другое":
+        st["step"] = "defect_custom"; send_prompt(chat, "DEFECT_CUSTOM"); return
+    data["defect_type"] = "" if text == "Без брака" else text
+    return finish(data, chat, flow)
+
+def _handle_defect_custom(st, data, text, chat, flow):
+    data["defect_type"] = text
+    return finish(data, chat, flow)
+
+HANDLERS = {
+    "line": _handle_line,
+    "date": _handle_date,
+    "date_custom": _handle_date_custom,
+    "time": _handle_time,
+    "time_custom": _handle_time_custom,
+    "action": _handle_action,
+    "reason": _handle_reason,
+    "reason_custom": _handle_reason_custom,
+    "znp_prefix": _handle_znp_prefix,
+    "znp_manual": _handle_znp_manual,
+    "meters": _handle_meters,
+    "defect_type": _handle_defect_type,
+    "defect_custom": _handle_defect_custom,
+}
+
+# ==================== Обработка сообщения ====================
+# Подпись пользователя нужна только в начале диалога; строим её раз на uid,
+# пока не сменится username
+USER_LABELS = {}
+
+def user_label(uid, username):
+    cached = USER_LABELS.get(uid)
+    if cached is None or cached[0] != username:
+        cached = USER_LABELS[uid] = (username, f"{uid} (@{username or 'no_user'})")
+    return cached[1]
+
+def _process(uid, chat, text, username):
+    touch(uid)
 
     # === Подтверждение удаления ===
     if uid in states and states[uid].get("step") == "delete_confirm":
         if text == "Да, удалить":
-            ws = states[uid]["data"]["ws"]
+            ws = WS_BY_TITLE[states[uid]["data"]["sheet"]]
             row_index = states[uid]["data"]["row_index"]
-            mark_as_deleted(ws, row_index)
-            send(chat, "Запись помечена как <b>Удалено</b>.", MAIN_KB)
+            mark_as_deleted(ws, row_index, states[uid]["data"]["row"])
+            send_prompt(chat, "DELETED")
         else:
-            send(chat, "Запись сохранена.", MAIN_KB)
+            send_prompt(chat, "KEPT")
         states.pop(uid, None)
         return
 
@@ -284,9 +1062,9 @@ def process(uid, chat, text, user_repr):
                     action = "Запуск" if r[3] == "запуск" else "Остановка"
                     reason = r[4] if len(r) > 4 else "—"
                     msg += f"• {r[0]} {r[1]} | Линия {r[2]} | {action} | {reason}\n"
-            send(chat, msg)
-            states[uid] = {"step": "line", "data": {}, "chat": chat, "flow": "startstop"}
-            send(chat, "Введите номер линии (1–15):", CANCEL_KB)
+            send(chat, msg, html=True)
+            states[uid] = {"step": "line", "data": {"user": user_label(uid, username)}, "chat": chat, "flow": "startstop"}
+            send_prompt(chat, "LINE")
             return
 
         if text == "Брак":
@@ -300,15 +1078,18 @@ def process(uid, chat, text, user_repr):
                     meters = r[5] if len(r) > 5 else "—"
                     defect = r[6] if len(r) > 6 else "—"
                     msg += f"• {r[0]} {r[1]} | Линия {r[2]} | <code>{znp}</code> | {meters}м | {defect}\n"
-            send(chat, msg)
-            states[uid] = {"step": "line", "data": {"action": "брак"}, "chat": chat, "flow": "defect"}
-            send(chat, "Введите номер линии (1–15):", CANCEL_KB)
+            send(chat, msg, html=True)
+            states[uid] = {"step": "line", "data": {"action": "брак", "user": user_label(uid, username)}, "chat": chat, "flow": "defect"}
+            send_prompt(chat, "LINE")
             return
 
         if text == "Отменить последнюю запись":
             success, sheet_name, row, ws, row_index = find_last_entry(uid)
+            if success is None:
+                send_prompt(chat, "SAVING")
+                return
             if not success:
-                send(chat, "У вас нет записей для отмены.", MAIN_KB)
+                send_prompt(chat, "NO_ENTRIES")
                 return
             action = row[3] if len(row) > 3 else "брак"
             znp = row[4] if len(row) > 4 else "—"
@@ -320,218 +1101,90 @@ def process(uid, chat, text, user_repr):
             msg += f"ЗНП: <code>{znp}</code>\n"
             msg += f"Брака: {meters}м | {defect}\n\n"
             msg += "<b>Удалить эту запись?</b> (статус → «Удалено»)"
-            send(chat, msg, CONFIRM_KB)
-            states[uid] = {"step": "delete_confirm", "chat": chat, "data": {"ws": ws, "row_index": row_index}}
+            send(chat, msg, CONFIRM_KB_JSON, html=True)
+            states[uid] = {"step": "delete_confirm", "chat": chat, "data": {"sheet": ws.title, "row_index": row_index, "row": row}}
             return
 
-        send(chat, "Выберите действие:", MAIN_KB)
+        send_prompt(chat, "MENU")
         return
 
     if text == "Отмена":
         states.pop(uid, None)
-        send(chat, "Отменено.", MAIN_KB)
+        send_prompt(chat, "CANCELLED")
         return
 
     st = states[uid]
-    step = st["step"]
-    data = st["data"]
-    flow = st.get("flow", "startstop")
-
-    # ==================== Все шаги (линия → дата → время → ...) ====================
-    if step == "line":
-        if not (text.isdigit() and 1 <= int(text) <= 15):
-            send(chat, "Номер линии 1–15:", CANCEL_KB); return
-        data["line"] = text
-        st["step"] = "date"
-        today = now_msk().strftime("%d.%m.%Y")
-        yest = (now_msk() - timedelta(days=1)).strftime("%d.%m.%Y")
-        send(chat, "Дата:", keyboard([[today, yest], ["Другая дата", "Отмена"]]))
-        return
+    handler = HANDLERS.get(st["step"])
+    if handler and handler(st, st["data"], text, chat, st.get("flow", "startstop")):
+        states.pop(uid, None)
 
-    if step == "date":
-        if text == "Другая дата":
-            st["step"] = "date_custom"; send(chat, "дд.мм.гггг:", CANCEL_KB); return
-        try:
-            datetime.strptime(text, "%d.%m.%Y")
-            data["date"] = text
-        except:
-            send(chat, "Неверная дата.", CANCEL_KB); return
-        st["step"] = "time"
-        now = now_msk()
-        t = [now.strftime("%H:%M"), (now-timedelta(minutes=10)).strftime("%H:%M"),
-             (now-timedelta(minutes=20)).strftime("%H:%M"), (now-timedelta(minutes=30)).strftime("%H:%M")]
-        send(chat, "Время:", keyboard([[t[0], t[1], "Другое время"], [t[2], t[3], "Отмена"]]))
-        return
+# ==================== Очередь обновлений: ответ Telegram сразу, обработка — в потоках ====================
+# Очередь выбирается по uid: сообщения одного пользователя идут строго по порядку
+UPDATE_WORKERS = 4
+UPDATES = [queue.Queue(maxsize=10000) for _ in range(UPDATE_WORKERS)]
 
-    if step == "date_custom":
+def handle_update(uid, chat, text, username):
+    try:
+        lock = lock_user(uid)
         try:
-            datetime.strptime(text, "%d.%m.%Y")
-            data["date"] = text
-            st["step"] = "time"
-            now = now_msk()
-            t = [now.strftime("%H:%M"), (now-timedelta(minutes=10)).strftime("%H:%M"),
-                 (now-timedelta(minutes=20)).strftime("%H:%M"), (now-timedelta(minutes=30)).strftime("%H:%M")]
-            send(chat, "Время:", keyboard([[t[0], t[1], "Другое время"], [t[2], t[3], "Отмена"]]))
-        except:
-            send(chat, "Формат дд.мм.гггг", CANCEL_KB)
-        return
-
-    if step == "time":
-        if text == "Другое время":
-            st["step"] = "time_custom"; send(chat, "чч:мм:", CANCEL_KB); return
-        if not (len(text) == 5 and text[2] == ":" and text[:2].isdigit() and text[3:].isdigit()):
-            send(chat, "Неверное время.", CANCEL_KB); return
-        data["time"] = text
-        if flow == "defect":
-            st["step"] = "znp_prefix"
-            curr = now_msk().strftime("%m%y")
-            prev = (now_msk() - timedelta(days=35)).strftime("%m%y")
-            kb = [[f"D{curr}", f"L{curr}"], [f"D{prev}", f"L{prev}"], ["Другое", "Отмена"]]
-            send(chat, "Префикс ЗНП:", keyboard(kb))
-        else:
-            st["step"] = "action"
-            send(chat, "Действие:", keyboard([["Запуск", "Остановка"], ["Отмена"]]))
-        return
-
-    if step == "time_custom":
-        if not (len(text) == 5 and text[2] == ":" and text[:2].isdigit() and text[3:].isdigit()):
-            send(chat, "Формат чч:мм", CANCEL_KB); return
-        data["time"] = text
-        if flow == "defect":
-            st["step"] = "znp_prefix"
-            curr = now_msk().strftime("%m%y")
-            prev = (now_msk() - timedelta(days=35)).strftime("%m%y")
-            kb = [[f"D{curr}", f"L{curr}"], [f"D{prev}", f"L{prev}"], ["Другое", "Отмена"]]
-            send(chat, "Префикс ЗНП:", keyboard(kb))
-        else:
-            st["step"] = "action"
-            send(chat, "Действие:", keyboard([["Запуск", "Остановка"], ["Отмена"]]))
-        return
-
-    if step == "action":
-        if text not in ("Запуск", "Остановка"):
-            send(chat, "Выберите:", keyboard([["Запуск", "Остановка"], ["Отмена"]])); return
-        data["action"] = "запуск" if text == "Запуск" else "остановка"
-        if data["action"] == "запуск":
-            st["step"] = "znp_prefix"
-        else:
-            st["step"] = "reason"
-            send(chat, "Причина остановки:", get_reasons_kb())
-        curr = now_msk().strftime("%m%y")
-        prev = (now_msk() - timedelta(days=35)).strftime("%m%y")
-        kb = [[f"D{curr}", f"L{curr}"], [f"D{prev}", f"L{prev}"], ["Другое", "Отмена"]]
-        if data["action"] == "запуск":
-            send(chat, "Префикс ЗНП:", keyboard(kb))
-        return
-
-    if step == "reason":
-        if text == "Другое":
-            st["step"] = "reason_custom"; send(chat, "Введите причину:", CANCEL_KB); return
-        data["reason"] = text
-        st["step"] = "znp_prefix"
-        curr = now_msk().strftime("%m%y")
-        prev = (now_msk() - timedelta(days=35)).strftime("%m%y")
-        kb = [[f"D{curr}", f"L{curr}"], [f"D{prev}", f"L{prev}"], ["Другое", "Отмена"]]
-        send(chat, "Префикс ЗНП:", keyboard(kb))
-        return
-
-    if step == "reason_custom":
-        data["reason"] = text
-        st["step"] = "znp_prefix"
-        curr = now_msk().strftime("%m%y")
-        prev = (now_msk() - timedelta(days=35)).strftime("%m%y")
-        kb = [[f"D{curr}", f"L{curr}"], [f"D{prev}", f"L{prev}"], ["Другое", "Отмена"]]
-        send(chat, "Префикс ЗНП:", keyboard(kb))
-        return
+            process(uid, chat, text, username)
+        finally:
+            lock.release()
+    except Exception as e:
+        log.exception(f"process error: {e}")
 
-    if step == "znp_prefix":
-        curr = now_msk().strftime("%m%y")
-        prev = (now_msk() - timedelta(days=35)).strftime("%m%y")
-        valid = [f"D{curr}", f"L{curr}", f"D{prev}", f"L{prev}"]
-        if text in valid:
-            data["znp_prefix"] = text
-            send(chat, f"Последние 4 цифры для <b>{text}</b>-XXXX:", CANCEL_KB); return
-        if text == "Другое":
-            st["step"] = "znp_manual"; send(chat, "Полный ЗНП (D1125-1234):", CANCEL_KB); return
-        if text.isdigit() and len(text) == 4 and "znp_prefix" in data:
-            data["znp"] = f"{data['znp_prefix']}-{text}"
-            st["step"] = "meters"; send(chat, "Метров брака:", CANCEL_KB); return
-        send(chat, "Выберите префикс:", keyboard([[f"D{curr}", f"L{curr}"], [f"D{prev}", f"L{prev}"], ["Другое", "Отмена"]]))
-        return
+def update_worker(q):
+    while True:
+        item = q.get()
+        try:
+            handle_update(*item)
+        finally:
+            q.task_done()
 
-    if step == "znp_manual":
-        curr = now_msk().strftime("%m%y")
-        prev = (now_msk() - timedelta(days=35)).strftime("%m%y")
-        if len(text) == 10 and text[5] == "-" and text[:5].upper() in [f"D{curr}", f"L{curr}", f"D{prev}", f"L{prev}"]:
-            data["znp"] = text.upper()
-            st["step"] = "meters"; send(chat, "Метров брака:", CANCEL_KB); return
-        send(chat, "Неправильно. Пример: <code>D1125-1234</code>", CANCEL_KB); return
-
-    if step == "meters":
-        if not text.isdigit():
-            send(chat, "Только цифры:", CANCEL_KB); return
-        data["meters"] = text
-        st["step"] = "defect_type"
-        send(chat, "Вид брака:", get_defect_kb())
-        return
+UPDATE_PUT_TIMEOUT = 2
 
-    if step == "defect_type":
-        if text == "Другое":
-            st["step"] = "defect_custom"; send(chat, "Опишите вид брака:", CANCEL_KB); return
-        data["defect_type"] = "" if text == "Без брака" else text
-        data["user"] = user_repr
-        data["flow"] = flow
-        append_row(data)
-
-        sheet_name = "Брак" if flow == "defect" else "Старт-Стоп"
-        action_text = "Брак" if flow == "defect" else ("Запуск" if data["action"] == "запуск" else "Остановка")
-        send(chat,
-             f"<b>Записано на лист '{sheet_name}'!</b>\n"
-             f"Линия {data['line']} • {data['date']} {data['time']}\n"
-             f"Действие: {action_text}\n"
-             f"Причина: {data.get('reason','—')}\n"
-             f"ЗНП: <code>{data.get('znp','—')}</code>\n"
-             f"Брака: {data['meters']} м\n"
-             f"Вид брака: {data.get('defect_type') or '—'}",
-             MAIN_KB)
-        states.pop(uid, None)
-        return
+def dispatch(uid, chat, text, username):
+    # Обрабатывать в запросе нельзя: апдейт обгонит уже стоящие в очереди апдейты того же
+    # пользователя. Ждём место недолго, иначе 503 — Telegram пришлёт апдейт повторно
+    try:
+        UPDATES[uid % UPDATE_WORKERS].put((uid, chat, text, username), timeout=UPDATE_PUT_TIMEOUT)
+        return True
+    except queue.Full:
+        log.warning(f"UPDATES переполнена, апдейт от {uid} вернём Telegram (503)")
+        return False
 
-    if step == "defect_custom":
-        data["defect_type"] = text
-        data["user"] = user_repr
-        data["flow"] = flow
-        append_row(data)
-        send(chat,
-             f"<b>Записано на лист '{'Брак' if flow=='defect' else 'Старт-Стоп'}'!</b>\n"
-             f"Линия {data['line']} • {data['date']} {data['time']}\n"
-             f"ЗНП: <code>{data.get('znp','—')}</code>\n"
-             f"Брака: {data['meters']} м\n"
-             f"Вид брака: {text}",
-             MAIN_KB)
-        states.pop(uid, None)
-        return
+for q in UPDATES:
+    threading.Thread(target=update_worker, args=(q,), daemon=True).start()
 
 # ==================== Flask ====================
 app = Flask(__name__)
-LOCK_PATH = "/tmp/bot.lock"
+# Ответ всегда один и тот же — готовые байты вместо jsonify на каждый запрос
+OK = (b'{"ok":true}', 200, JSON_HEADERS)
 
 @app.route("/health")
-def health(): return {"ok": True}
+def health(): return OK
 
 @app.route(f"/webhook/{TELEGRAM_TOKEN}", methods=["POST"])
 def webhook():
-    upd = request.get_json(silent=True)
-    if not upd or "message" not in upd: return {"ok": True}
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(), WEBHOOK_SECRET):
+        return "", 403
+    raw = request.get_data(cache=False)
+    # edited_message, callback_query, channel_post и т.п. не обрабатываем — не разбираем и JSON
+    if b'"message"' not in raw:
+        return OK
+    try:
+        upd = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return OK
+    if not upd or "message" not in upd: return OK
     m = upd["message"]
     chat = m["chat"]["id"]
     uid = m["from"]["id"]
     text = (m.get("text") or "").strip()
-    user_repr = f"{uid} (@{m['from'].get('username','') or 'no_user'})"
-
-    with FileLock(LOCK_PATH):
-        process(uid, chat, text, user_repr)
-    return {"ok": True}
+    if not dispatch(uid, chat, text, m["from"].get("username")):
+        return "", 503
+    return OK
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
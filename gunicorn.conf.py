@@ -0,0 +1,13 @@
+# gunicorn.conf.py — подхватывается gunicorn автоматически из рабочей папки
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# Состояния диалогов живут в памяти процесса — воркер один, параллельность за счёт потоков.
+# С REDIS_URL воркеров можно больше (WEB_CONCURRENCY).
+# WEB_CONCURRENCY платформа может выставить сама — без Redis его не слушаем
+workers = int(os.environ.get("WEB_CONCURRENCY", 1)) if os.environ.get("REDIS_URL") else 1
+# GUNICORN_WORKER_CLASS=gevent — зелёные потоки вместо системных (нужен пакет gevent;
+# gunicorn сам делает monkey.patch_all, так что requests/gspread не блокируют воркер)
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))